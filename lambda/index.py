@@ -1,9 +1,17 @@
+import base64
+import gzip
+import itertools
 import json
 import os
 import logging
-import urllib.request
-import urllib.error
-from typing import List, Dict, Any
+import random
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Dict, Any, Tuple, Union
+
+import urllib3
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
@@ -13,55 +21,324 @@ LLM_API_URL: str = os.environ.get(
     "https://NGROK_URL.ngrok-free.app/generate"  # ← 必ず置き換える
 )
 TIMEOUT: int = int(os.environ.get("LLM_API_TIMEOUT", "60"))
+CONNECT_TIMEOUT: float = 5.0
+# Transient failures are retried with exponential backoff, but only while the
+# call is still inside its deadline (see _start_deadline / _post_llm).
+MAX_RETRIES: int = int(os.environ.get("LLM_API_MAX_RETRIES", "3"))
+BACKOFF_FACTOR: float = 0.2
+# API Gateway REST integrations give up after 29 s (measured from when API
+# Gateway received the request) and answer 504 without our CORS headers.
+API_GATEWAY_TIMEOUT: float = float(os.environ.get("API_GATEWAY_TIMEOUT", "29"))
+# Left for returning a proper 502 (with CORS headers) before API Gateway or
+# Lambda gives up on us; also absorbs clock skew between the two.
+DEADLINE_MARGIN: float = 3.0
+POOL_MAXSIZE: int = int(os.environ.get("LLM_POOL_MAXSIZE", "20"))
+MAX_CONCURRENCY: int = int(os.environ.get("LLM_MAX_CONCURRENCY", "10"))
+# Longest "messages" batch accepted in one invocation.
+MAX_BATCH_MESSAGES: int = int(os.environ.get("MAX_BATCH_MESSAGES", "20"))
+# Set to "1" only if the backend accepts {"prompts": [...]} and answers with
+# {"generated_texts": [...]}, so it can batch them on its side.
+BATCH_API: bool = os.environ.get("LLM_API_BATCH", "0") == "1"
+# Set to "1" only if the backend accepts {"messages": [{role, content}, ...]}
+# and applies the model's chat template itself.
+CHAT_API: bool = os.environ.get("LLM_API_CHAT", "0") == "1"
+# Upper bounds on what is sent to the LLM, to cap prefill cost and latency.
+MAX_HISTORY_TURNS: int = int(os.environ.get("MAX_HISTORY_TURNS", "20"))
+MAX_PROMPT_CHARS: int = int(os.environ.get("MAX_PROMPT_CHARS", "8000"))
+# Set to "1" only if the backend decompresses gzip request bodies.
+GZIP_REQUEST: bool = os.environ.get("LLM_API_GZIP_REQUEST", "0") == "1"
+# Open the LLM_API connection during Lambda INIT rather than on the first call.
+PREWARM: bool = os.environ.get("LLM_API_PREWARM", "1") == "1"
+
+if os.environ.get("LLM_API_IPV4_ONLY", "0") == "1":
+    # skip AAAA lookups / IPv6 attempts for IPv4-only tunnels
+    urllib3.util.connection.HAS_IPV6 = False
+
+# Module scope so the keep-alive sockets survive across warm invocations.
+_HTTP = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=POOL_MAXSIZE,
+    # urllib3 restarts the timeout on every retry, so _post_llm retries itself
+    # against a single deadline instead.
+    retries=False,
+    headers={"Connection": "keep-alive"},
+)
+# Resolve the pool and request path once instead of re-parsing the URL and
+# looking the pool up in the PoolManager on every call.
+_LLM_POOL = _HTTP.connection_from_url(LLM_API_URL)
+_LLM_PATH: str = urllib3.util.parse_url(LLM_API_URL).request_uri
+
+if PREWARM:
+    # Pays DNS + TCP + TLS at import time and leaves the socket in the pool.
+    # The backend may well answer 405; only the connection matters here.
+    try:
+        _LLM_POOL.request(
+            "OPTIONS", _LLM_PATH, timeout=urllib3.Timeout(total=2.0), retries=False
+        )
+    except Exception as warm_err:  # best effort; the first call connects itself
+        LOGGER.warning("LLM_API prewarm failed: %r", warm_err)
+
+# Generation parameters are constant, so their JSON is encoded once and
+# each request only splices in the encoded prompt in front of it.
+_GEN_DEFAULTS: Dict[str, Any] = {
+    "max_new_tokens": 256,
+    "do_sample": True,
+    "temperature": 0.7,
+    "top_p": 0.9,
+}
+if os.environ.get("LLM_SEED"):
+    _GEN_DEFAULTS["seed"] = int(os.environ["LLM_SEED"])
+# Sampled output is only reproducible (and therefore cacheable) with a seed.
+_CACHEABLE: bool = not _GEN_DEFAULTS["do_sample"] or "seed" in _GEN_DEFAULTS
+_GEN_PARAMS_KEY = tuple(sorted(_GEN_DEFAULTS.items()))
+_REQ_BODY_TAIL: bytes = b"," + json.dumps(
+    _GEN_DEFAULTS, separators=(",", ":")
+).encode("utf-8")[1:]
+_REQ_HEADERS = {
+    "Content-Type": "application/json",
+    "Connection": "keep-alive",
+    # gzip/deflate (plus br/zstd when their modules are installed);
+    # urllib3 decodes the response transparently.
+    **urllib3.util.make_headers(accept_encoding=True),
+}
+if GZIP_REQUEST:
+    _REQ_HEADERS["Content-Encoding"] = "gzip"
+# Gateway errors from ngrok/uvicorn restarts, and connections that failed to
+# open or were reset (e.g. a stale keep-alive socket). Read timeouts are not
+# retried: the backend is still generating and a resend only doubles its load.
+_RETRY_STATUSES = frozenset((502, 503, 504))
+_RETRY_ERRORS = (
+    urllib3.exceptions.ConnectTimeoutError,  # includes NewConnectionError
+    urllib3.exceptions.ProtocolError,  # RemoteDisconnected, ConnectionResetError
+)
 
-HEADERS = {
+# Monotonic time by which LLM_API calls of the running invocation must end.
+# A container serves one invocation at a time, so a module global is enough
+# and is visible to the _EXEC worker threads.
+_DEADLINE: float = float("inf")
+
+# Shared by warm invocations, like _LLM_POOL; the pool is thread-safe.
+_EXEC = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+
+# Read-only so no invocation can alter the headers later responses share.
+HEADERS = types.MappingProxyType({
     "Content-Type": "application/json",
     "Access-Control-Allow-Origin": "*",
     "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,"
     "X-Api-Key,X-Amz-Security-Token",
     "Access-Control-Allow-Methods": "OPTIONS,POST",
-}
+})
 
 # ---------------------------------------------------------------------------
 # Helper utilities
 # ---------------------------------------------------------------------------
-def _build_prompt(messages: List[Dict[str, str]], latest_user_msg: str) -> str:
+def _response(status_code: int, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Return an API Gateway proxy response carrying `payload` as JSON."""
+    return {
+        "statusCode": status_code,
+        # the runtime JSON-encodes the result, which needs a real dict
+        "headers": dict(HEADERS),
+        "body": json.dumps(payload, ensure_ascii=False, separators=(",", ":")),
+    }
+
+
+# A flattened prompt string, or (role, content) turns for the chat API.
+Prompt = Union[str, Tuple[Tuple[str, str], ...]]
+
+
+def _history_start(messages: List[Tuple[str, str]], latest_user_msg: str) -> int:
+    """Return the index of the oldest history entry that fits the budgets.
+
+    Only the last MAX_HISTORY_TURNS history entries are used, and the oldest
+    of those are dropped until the prompt fits in MAX_PROMPT_CHARS.
+    """
+    start = max(0, len(messages) - MAX_HISTORY_TURNS)
+    # each history entry contributes its content plus one "\n" separator
+    total = len(latest_user_msg) + sum(
+        len(content) + 1 for _, content in itertools.islice(messages, start, None)
+    )
+    while start < len(messages) and total > MAX_PROMPT_CHARS:
+        total -= len(messages[start][1]) + 1
+        start += 1
+    return start
+
+
+def _build_prompt(messages: List[Tuple[str, str]], latest_user_msg: str) -> str:
     """Return a newline-concatenated prompt without 'user:' / 'assistant:' labels."""
-    text_parts: List[str] = [m["content"] for m in messages]
-    text_parts.append(latest_user_msg)
-    return "\n".join(text_parts)
+    start = _history_start(messages, latest_user_msg)
+    return "\n".join(
+        itertools.chain(
+            (content for _, content in itertools.islice(messages, start, None)),
+            (latest_user_msg,),
+        )
+    )
 
 
-def _call_llm(prompt: str) -> str:
-    """POST the prompt to external FastAPI and return generated text."""
-    req_body = json.dumps(
-        {
-            "prompt": prompt.strip(),
-            "max_new_tokens": 256,
-            "do_sample": True,
-            "temperature": 0.7,
-            "top_p": 0.9,
-        }
+def _build_chat(
+    messages: List[Tuple[str, str]], latest_user_msg: str
+) -> Tuple[Tuple[str, str], ...]:
+    """Return the (role, content) turns to send when CHAT_API is enabled.
+
+    Many chat templates require the turns to start with "user" and to
+    alternate, so the window starts at a user entry and consecutive turns of
+    the same role (e.g. a user message whose request failed, which the
+    frontend keeps in the history) are merged into one.
+    """
+    start = _history_start(messages, latest_user_msg)
+    while start < len(messages) and messages[start][0] != "user":
+        start += 1
+    turns: List[Tuple[str, str]] = []
+    for role, content in itertools.chain(
+        itertools.islice(messages, start, None), (("user", latest_user_msg),)
+    ):
+        if turns and turns[-1][0] == role:
+            turns[-1] = (role, turns[-1][1] + "\n" + content)
+        else:
+            turns.append((role, content))
+    return tuple(turns)
+
+
+_make_prompt = _build_chat if CHAT_API else _build_prompt
+
+
+def _encode_prompt(prompt: Prompt) -> bytes:
+    """Return the opening of the request JSON, up to the generation params."""
+    if isinstance(prompt, str):
+        return b'{"prompt":' + json.dumps(
+            prompt.strip(), ensure_ascii=False
+        ).encode("utf-8")
+    return b'{"messages":' + json.dumps(
+        [{"role": role, "content": content} for role, content in prompt],
+        ensure_ascii=False,
     ).encode("utf-8")
 
-    request = urllib.request.Request(
-        LLM_API_URL,
-        data=req_body,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
 
-    try:
-        with urllib.request.urlopen(request, timeout=TIMEOUT) as resp:
-            rsp_json = json.loads(resp.read().decode("utf-8"))
-            return rsp_json["generated_text"]
-    except urllib.error.HTTPError as http_err:
-        err_detail = http_err.read().decode("utf-8", errors="ignore")
-        LOGGER.error("LLM_API HTTPError %s — %s", http_err.code, err_detail)
-        raise
-    except Exception:
-        LOGGER.exception("Unexpected error calling LLM_API")
-        raise
+def _start_deadline(event: Dict[str, Any], context) -> None:
+    """Bound the LLM_API calls of this invocation by the time left to answer.
+
+    That is the Lambda's remaining time and, for API Gateway requests, the
+    integration timeout counted from `requestContext.requestTimeEpoch` (or
+    from now when it is missing), each less DEADLINE_MARGIN.
+    """
+    global _DEADLINE
+    budgets: List[float] = []
+    if context is not None:
+        budgets.append(context.get_remaining_time_in_millis() / 1000)
+    request_context = event.get("requestContext")
+    if isinstance(request_context, dict):
+        epoch_ms = request_context.get("requestTimeEpoch")
+        if isinstance(epoch_ms, (int, float)):
+            budgets.append(epoch_ms / 1000 + API_GATEWAY_TIMEOUT - time.time())
+        else:
+            budgets.append(API_GATEWAY_TIMEOUT)
+    if not budgets:
+        _DEADLINE = float("inf")
+        return
+    _DEADLINE = time.monotonic() + min(budgets) - DEADLINE_MARGIN
+
+
+def _backoff(attempt: int, deadline: float) -> bool:
+    """Sleep before retry number `attempt + 1`; False if it must not happen."""
+    if attempt >= MAX_RETRIES:
+        return False
+    # jittered so concurrent batch calls do not all retry at the same moment
+    delay = BACKOFF_FACTOR * (2 ** attempt) * random.uniform(0.5, 1.5)
+    if time.monotonic() + delay >= deadline:
+        return False
+    time.sleep(delay)
+    return True
+
+
+def _post_llm(req_body: bytes) -> Dict[str, Any]:
+    """POST an encoded request body to external FastAPI and return its JSON.
+
+    Every attempt, retries and backoff included, has to finish within
+    TIMEOUT seconds and before the invocation's deadline.
+    """
+    if GZIP_REQUEST:
+        req_body = gzip.compress(req_body, compresslevel=1)
+    deadline = min(_DEADLINE, time.monotonic() + TIMEOUT)
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            LOGGER.error("LLM_API deadline exceeded after %d attempt(s)", attempt)
+            raise TimeoutError("LLM_API deadline exceeded")
+        try:
+            resp = _LLM_POOL.request(
+                "POST",
+                _LLM_PATH,
+                body=req_body,
+                headers=_REQ_HEADERS,
+                timeout=urllib3.Timeout(
+                    connect=min(CONNECT_TIMEOUT, remaining),
+                    read=remaining,
+                    total=remaining,
+                ),
+            )
+        except _RETRY_ERRORS as net_err:
+            if _backoff(attempt, deadline):
+                attempt += 1
+                LOGGER.warning("LLM_API retry %d after %r", attempt, net_err)
+                continue
+            LOGGER.error("LLM_API network error: %r", net_err)
+            raise
+        except (urllib3.exceptions.HTTPError, TimeoutError, ConnectionError) as net_err:
+            # routine with ngrok; a one-line log avoids formatting a traceback
+            LOGGER.error("LLM_API network error: %r", net_err)
+            raise
+        except Exception:
+            LOGGER.exception("Unexpected error calling LLM_API")
+            raise
+
+        if resp.status < 400:
+            # json.loads accepts UTF-8 bytes directly; no intermediate str needed.
+            return json.loads(resp.data)
+
+        err_detail = resp.data.decode("utf-8", errors="ignore")
+        if resp.status in _RETRY_STATUSES and _backoff(attempt, deadline):
+            attempt += 1
+            LOGGER.warning("LLM_API retry %d after HTTP %s", attempt, resp.status)
+            continue
+        LOGGER.error("LLM_API HTTPError %s — %s", resp.status, err_detail)
+        raise RuntimeError(f"LLM_API HTTPError {resp.status}")
+
+
+def _generate(prompt: Prompt) -> str:
+    """POST the prompt to external FastAPI and return generated text."""
+    req_body = _encode_prompt(prompt) + _REQ_BODY_TAIL
+    return _post_llm(req_body)["generated_text"]
+
+
+@lru_cache(maxsize=256)
+def _cached_call(prompt: Prompt, params_key: tuple) -> str:
+    """`_generate`, memoised per warm container on (prompt, params)."""
+    return _generate(prompt)
+
+
+def _call_llm(prompt: Prompt) -> str:
+    """Return generated text, from the cache when the output is deterministic."""
+    if _CACHEABLE:
+        return _cached_call(prompt, _GEN_PARAMS_KEY)
+    return _generate(prompt)
+
+
+def _call_llm_batch(prompts: List[str]) -> List[str]:
+    """POST all prompts in one request (`{"prompts": [...]}`) and return texts."""
+    req_body = b'{"prompts":' + json.dumps(
+        [p.strip() for p in prompts], ensure_ascii=False
+    ).encode("utf-8") + _REQ_BODY_TAIL
+    texts: List[str] = _post_llm(req_body)["generated_texts"]
+    if len(texts) != len(prompts):
+        raise RuntimeError(
+            f"LLM_API returned {len(texts)} texts for {len(prompts)} prompts"
+        )
+    return texts
+
+
+def _call_llm_many(prompts: List[Prompt]) -> List[str]:
+    """Call LLM_API for every prompt concurrently, preserving order."""
+    return list(_EXEC.map(_call_llm, prompts))
 
 
 # ---------------------------------------------------------------------------
@@ -69,55 +346,92 @@ def _call_llm(prompt: str) -> str:
 # ---------------------------------------------------------------------------
 def lambda_handler(event: Dict[str, Any], context):  # noqa: D401
     """Main Lambda handler (API Gateway proxy integration)."""
-    LOGGER.info("event=%s", event)
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("event=%s", event)
+    request_id = event.get("requestContext", {}).get("requestId", "")
+    _start_deadline(event, context)
 
     # 1) parse request body ---------------------------------------------------
     try:
-        body = event.get("body", event)
-        if isinstance(body, str):
-            body = json.loads(body)
+        raw = event.get("body")
+        if raw is None:
+            body = event  # direct invocation: the event is the body
+        else:
+            if event.get("isBase64Encoded"):
+                raw = base64.b64decode(raw)  # json.loads takes the bytes as-is
+            body = json.loads(raw) if isinstance(raw, (str, bytes, bytearray)) else raw
+        if not isinstance(body, dict):
+            raise TypeError("request body must be a JSON object")
 
-        user_message: str = body["message"]
-        conversation_history: List[Dict[str, str]] = body.get(
-            "conversationHistory", []
-        )
+        # (role, content) tuples internally; dicts only at the JSON boundary
+        conversation_history: List[Tuple[str, str]] = [
+            (m["role"], m["content"]) for m in body.get("conversationHistory", [])
+        ]
+        if not all(
+            isinstance(role, str) and isinstance(content, str)
+            for role, content in conversation_history
+        ):
+            raise TypeError("conversationHistory roles and contents must be strings")
+        batch_messages = body.get("messages")
+        if isinstance(batch_messages, list):
+            if not 0 < len(batch_messages) <= MAX_BATCH_MESSAGES:
+                raise ValueError(
+                    f"messages must hold 1 to {MAX_BATCH_MESSAGES} entries"
+                )
+            if not all(isinstance(m, str) for m in batch_messages):
+                raise TypeError("messages must be a list of strings")
+        else:
+            user_message: str = body["message"]
+            if not isinstance(user_message, str):
+                raise TypeError("message must be a string")
     except (KeyError, ValueError, TypeError):
         LOGGER.exception("Bad request format")
-        return {
-            "statusCode": 400,
-            "headers": HEADERS,
-            "body": json.dumps({"success": False, "error": "bad request"}),
-        }
+        return _response(400, {"success": False, "error": "bad request"})
+
+    # 1') batch: answer every message against the same history --------------
+    if isinstance(batch_messages, list):
+        LOGGER.info(
+            "rid=%s batch=%d hist_len=%d",
+            request_id, len(batch_messages), len(conversation_history),
+        )
+        prompts = [_make_prompt(conversation_history, m) for m in batch_messages]
+        try:
+            # the batch contract only carries flattened prompt strings
+            if BATCH_API and not CHAT_API:
+                responses = _call_llm_batch(prompts)
+            else:
+                responses = _call_llm_many(prompts)
+        except Exception as call_err:
+            return _response(502, {"success": False, "error": str(call_err)})
+        return _response(200, {"success": True, "responses": responses})
+
+    LOGGER.info(
+        "rid=%s msg_len=%d hist_len=%d",
+        request_id, len(user_message), len(conversation_history),
+    )
 
     # 2) build prompt ---------------------------------------------------------
-    prompt = _build_prompt(conversation_history, user_message)
+    prompt = _make_prompt(conversation_history, user_message)
 
     # 3) call external LLM ----------------------------------------------------
     try:
         assistant_response = _call_llm(prompt)
     except Exception as call_err:
-        return {
-            "statusCode": 502,
-            "headers": HEADERS,
-            "body": json.dumps({"success": False, "error": str(call_err)}),
-        }
+        return _response(502, {"success": False, "error": str(call_err)})
 
     # 4) assemble new conversation history -----------------------------------
-    new_history = conversation_history + [
+    new_history = [
+        *({"role": role, "content": content} for role, content in conversation_history),
         {"role": "user", "content": user_message},
         {"role": "assistant", "content": assistant_response},
     ]
 
     # 5) return payload ------------------------------
-    return {
-        "statusCode": 200,
-        "headers": HEADERS,
-        "body": json.dumps(
-            {
-                "success": True,
-                "response": assistant_response,
-                "conversationHistory": new_history,
-            },
-            ensure_ascii=False,
-        ),
-    }
\ No newline at end of file
+    return _response(
+        200,
+        {
+            "success": True,
+            "response": assistant_response,
+            "conversationHistory": new_history,
+        },
+    )
\ No newline at end of file